@@ -1,14 +1,31 @@
+import hashlib
+import json
 import logging
 import os
-from datetime import datetime, timedelta, timezone  # Added timezone
+import re
+import threading
+import time
 from functools import wraps
 
 import jwt  # Import jwt
+import orjson
+import requests
+from cachetools import TLRUCache
 from dotenv import load_dotenv
-from flask import Flask, g, jsonify, request  # Import g
+from flask import (
+    Flask,
+    Response,
+    current_app,
+    g,
+    jsonify,
+    request,
+    stream_with_context,
+)
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from google.auth import exceptions as google_exceptions
+from google.auth import jwt as google_jwt
 from google.auth.transport import requests as google_requests
-from google.oauth2 import id_token
 
 # Assuming db_utils is in the same directory or package
 try:
@@ -18,11 +35,33 @@ except ImportError:
 
 load_dotenv()
 
-app = Flask(__name__)
+
+# --- JSON Setup ---
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson. Output matches the default provider
+    (sorted keys, HTTP-date datetimes) but is encoded in native code.
+    """
+
+    option = (
+        orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    )
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 # --- Logging Setup ---
-# Use Flask's built-in logger
-logging.basicConfig(level=logging.INFO)
+# Same logger Flask exposes as app.logger (named after this module); set
+# LOG_LEVEL=WARNING in production to skip formatting of per-request messages
+# entirely (they use lazy %-style args)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL)
+logging.getLogger().setLevel(LOG_LEVEL)  # db_utils may have configured it first
+logger = logging.getLogger(__name__)
 # You might want more sophisticated logging configuration for production
 # Example: logging.FileHandler, logging.StreamHandler, formatters etc.
 # ---------------------
@@ -37,99 +76,221 @@ allowed_origins = [
     "https://geography-game-test.up.railway.app",
     "https://geography-game-geography-game-pr-22.up.railway.app",
 ]
+# One compiled alternation lets Flask-CORS match an Origin with a single regex
+# call instead of comparing it against every entry in turn.
+allowed_origins_pattern = re.compile(
+    "(?:" + "|".join(re.escape(origin) for origin in allowed_origins) + r")\Z",
+    re.IGNORECASE,
+)
 
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")  # Load JWT Secret
 
 if not GOOGLE_CLIENT_ID:
-    app.logger.critical(
-        "FATAL ERROR: GOOGLE_CLIENT_ID not found in environment variables."
-    )
+    logger.critical("FATAL ERROR: GOOGLE_CLIENT_ID not found in environment variables.")
     raise ValueError("Missing GOOGLE_CLIENT_ID")
 else:
-    app.logger.info("GOOGLE_CLIENT_ID loaded successfully.")
+    logger.info("GOOGLE_CLIENT_ID loaded successfully.")
 
 if not JWT_SECRET_KEY:
-    app.logger.critical(
-        "FATAL ERROR: JWT_SECRET_KEY not found in environment variables."
-    )
+    logger.critical("FATAL ERROR: JWT_SECRET_KEY not found in environment variables.")
     raise ValueError("Missing JWT_SECRET_KEY")
 else:
-    app.logger.info("JWT_SECRET_KEY loaded successfully.")
+    logger.info("JWT_SECRET_KEY loaded successfully.")
+# Encode once; PyJWT would otherwise re-encode the str key on every sign/verify
+JWT_SECRET_KEY_BYTES = JWT_SECRET_KEY.encode("utf-8")
+JWT_ALGORITHMS = ["HS256"]
+ACCESS_TOKEN_LIFETIME = 3600  # Seconds
+# One shared codec so options are merged once, not rebuilt on every call
+jwt_codec = jwt.PyJWT(options={"require": ["exp", "iat"]})
 # ---------------------
 
 
-# --- CORS Setup ---
-CORS(
-    app,
-    resources={r"/api/*": {"origins": allowed_origins}},
-    methods=[
-        "GET",
-        "POST",
-        "PUT",
-        "PATCH",
-        "DELETE",
-        "OPTIONS",
-    ],
-    allow_headers=["Content-Type", "Authorization"],  # Ensure Authorization is allowed
-    supports_credentials=True,
+# --- Google Token Verification ---
+# Reuse one transport (and its requests.Session) so connections to Google stay warm
+google_session = requests.Session()
+google_session.mount(
+    "https://",
+    # One pooled connection per gunicorn thread (see Procfile)
+    requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8),
+)
+google_request = google_requests.Request(session=google_session)
+
+# Verified ID tokens are cached by SHA-256 digest (never the raw token) until
+# the earlier of the token's own expiry or GOOGLE_TOKEN_CACHE_TTL seconds.
+GOOGLE_TOKEN_CACHE_TTL = 300
+google_token_cache = TLRUCache(
+    maxsize=10000,
+    ttu=lambda _key, id_info, now: min(id_info["exp"], now + GOOGLE_TOKEN_CACHE_TTL),
+    timer=time.time,
 )
-app.logger.info(f"CORS enabled for origins: {allowed_origins}")
+google_token_cache_lock = threading.Lock()
+
+# Google's signing certificates rotate rarely, so they are cached for as long
+# as Google's Cache-Control max-age allows instead of being fetched per login.
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_CERTS_DEFAULT_TTL = 300
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+google_certs_cache = TLRUCache(
+    maxsize=1,
+    ttu=lambda _key, entry, _now: entry[1],
+    timer=time.time,
+)
+google_certs_cache_lock = threading.Lock()
+# An unknown kid (key rotation, or a forged header) forces a refetch at most
+# once per interval; otherwise the token fails to verify against cached certs.
+GOOGLE_CERTS_MIN_REFRESH_INTERVAL = 60
+google_certs_last_fetch = 0.0  # time.monotonic() of the last fetch
 # ---------------------
 
 
+# --- CORS Setup ---
+CORS_OPTIONS = {
+    "resources": {r"/api/*": {"origins": allowed_origins_pattern}},
+    "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+    # Ensure Authorization is allowed
+    "allow_headers": ["Content-Type", "Authorization"],
+    "supports_credentials": True,
+    "max_age": 86400,  # Let browsers cache preflight results for 24h
+}
+
+
+def short_circuit_preflight():
+    # Answer CORS preflights before routing reaches views or decorators;
+    # Flask-CORS still adds the Access-Control-* headers in after_request.
+    # Plain OPTIONS requests and unknown paths fall through to Flask (Allow
+    # header / 404); request.url_rule is None when routing found no match.
+    if (
+        request.method == "OPTIONS"
+        and "Access-Control-Request-Method" in request.headers
+        and request.url_rule is not None
+        and request.path.startswith("/api/")
+    ):
+        return "", 204
+
+
+# ---------------------
+
+
+def get_google_certs(key_id):
+    """
+    Returns Google's ID token signing certificates, fetching them only when
+    the cached set has expired, or does not contain key_id (key rotation) and
+    no fetch happened in the last GOOGLE_CERTS_MIN_REFRESH_INTERVAL seconds.
+    The fetch runs under the cache lock, so concurrent misses share one fetch.
+    """
+    global google_certs_last_fetch
+    with google_certs_cache_lock:
+        entry = google_certs_cache.get(GOOGLE_CERTS_URL)
+        if entry is not None and (
+            key_id is None
+            or key_id in entry[0]
+            or time.monotonic()
+            < google_certs_last_fetch + GOOGLE_CERTS_MIN_REFRESH_INTERVAL
+        ):
+            return entry[0]
+
+        response = google_request(GOOGLE_CERTS_URL, method="GET")
+        if response.status != 200:
+            raise google_exceptions.TransportError(
+                f"Could not fetch certificates at {GOOGLE_CERTS_URL}"
+            )
+        certs = json.loads(response.data.decode("utf-8"))
+
+        max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        ttl = int(max_age.group(1)) if max_age else GOOGLE_CERTS_DEFAULT_TTL
+        google_certs_cache[GOOGLE_CERTS_URL] = (certs, time.time() + ttl)
+        google_certs_last_fetch = time.monotonic()
+        return certs
+
+
+def verify_google_token(token):
+    """
+    Verifies a Google ID token, reusing the result for recently verified tokens.
+    Equivalent to id_token.verify_oauth2_token, but with cached certificates.
+    Raises ValueError if the token is invalid.
+    """
+    cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    with google_token_cache_lock:
+        id_info = google_token_cache.get(cache_key)
+    if id_info is None:
+        certs = get_google_certs(google_jwt.decode_header(token).get("kid"))
+        id_info = google_jwt.decode(token, certs=certs, audience=GOOGLE_CLIENT_ID)
+        if id_info.get("iss") not in GOOGLE_ISSUERS:
+            raise ValueError(f"Wrong issuer: {id_info.get('iss')}")
+        with google_token_cache_lock:
+            google_token_cache[cache_key] = id_info
+    return id_info
+
+
 # --- JWT Authentication Decorator ---
+# Decoded JWTs and their users are cached by token digest for a short time so
+# repeat API calls skip signature verification and the user lookup.
+AUTH_CACHE_TTL = 30
+auth_cache = TLRUCache(
+    maxsize=10000,
+    ttu=lambda _key, entry, now: min(entry[0]["exp"], now + AUTH_CACHE_TTL),
+    timer=time.time,
+)
+auth_cache_lock = threading.Lock()
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        # --- Add this check at the beginning ---
-        if request.method == "OPTIONS":
-            # Allow CORS preflight requests to pass through without token check
-            # We rely on Flask-CORS to handle the actual OPTIONS response later
-            return f(
-                *args, **kwargs
-            )  # Or potentially just `return app.make_default_options_response()`
-            # but letting it pass to the route which also checks OPTIONS is safer.
-        # ---------------------------------------
+        # CORS preflights never reach here: short_circuit_preflight answers them
         token = None
         # Check for Bearer token in Authorization header
-        if "Authorization" in request.headers:
-            auth_header = request.headers["Authorization"]
+        auth_header = request.headers.get("Authorization")
+        if auth_header is not None:
+            # split() separates on any whitespace run, so "Bearer\t<token>" works
             parts = auth_header.split()
-            if len(parts) == 2 and parts[0].lower() == "bearer":
-                token = parts[1]
-            else:
-                app.logger.warning("Malformed Authorization header received.")
+            token = parts[1] if len(parts) == 2 else None
+            if token is None or parts[0].lower() != "bearer":
+                logger.warning("Malformed Authorization header received.")
                 return jsonify({"message": "Malformed token header"}), 401
 
         if not token:
-            app.logger.warning("Missing token for protected route.")
+            logger.warning("Missing token for protected route.")
             return jsonify({"message": "Token is missing!"}), 401
 
+        cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+        with auth_cache_lock:
+            cached = auth_cache.get(cache_key)
+        if cached is not None:
+            g.current_user = cached[1]
+            return f(*args, **kwargs)
+
         try:
             # Verify and decode the token
-            data = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
-            # Fetch user details from DB using ID stored in token
+            data = jwt_codec.decode(
+                token, JWT_SECRET_KEY_BYTES, algorithms=JWT_ALGORITHMS
+            )
+            # Fetch the user's id and admin flag from DB using ID stored in token
             # Store user info in Flask's 'g' object for access within the request context
-            g.current_user = db_utils.get_user_by_id(data["user_id"])
+            g.current_user = db_utils.get_user_auth_fields(data["user_id"])
             if not g.current_user:
-                app.logger.error(
-                    f"User ID {data['user_id']} from valid token not found in DB."
+                logger.error(
+                    "User ID %s from valid token not found in DB.", data["user_id"]
                 )
                 return jsonify(
                     {"message": "User not found"}
                 ), 401  # Or 404? 401 seems better.
 
         except jwt.ExpiredSignatureError:
-            app.logger.warning("Expired token received.")
+            logger.warning("Expired token received.")
             return jsonify({"message": "Token has expired!"}), 401
         except jwt.InvalidTokenError as e:
-            app.logger.error(f"Invalid token received: {e}")
+            logger.error("Invalid token received: %s", e)
             return jsonify({"message": "Token is invalid!"}), 401
+        except db_utils.PoolTimeout:
+            raise  # Answered with 503 by handle_pool_timeout
         except Exception as e:
-            app.logger.error(f"Unexpected error during token verification: {e}")
+            logger.error("Unexpected error during token verification: %s", e)
             return jsonify({"message": "Error processing token"}), 500
 
+        with auth_cache_lock:
+            auth_cache[cache_key] = (data, g.current_user)
         return f(*args, **kwargs)  # Proceed to the original route function
 
     return decorated
@@ -139,31 +300,26 @@ def token_required(f):
 
 
 # --- Routes ---
-@app.route("/api/auth/google", methods=["POST", "OPTIONS"])
 def auth_google():
     """
     Receives Google ID token, verifies it, adds/updates user,
     and returns user info along with a JWT access token.
     """
-    if request.method == "OPTIONS":
-        return app.make_default_options_response()
-
-    if not request.is_json:
+    # Parse the body once with orjson instead of is_json + get_json()
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
         return jsonify({"error": "Request must be JSON"}), 415
-
-    data = request.get_json()
-    token = data.get("token")
+    token = data.get("token") if isinstance(data, dict) else None
 
     if not token:
         return jsonify({"error": "Missing token"}), 400
 
-    app.logger.info("Received Google token for verification...")
+    logger.debug("Received Google token for verification...")
 
     try:
-        id_info = id_token.verify_oauth2_token(
-            token, google_requests.Request(), GOOGLE_CLIENT_ID
-        )
-        app.logger.info("Google token verified successfully.")
+        id_info = verify_google_token(token)
+        logger.debug("Google token verified successfully.")
 
         google_id = id_info["sub"]
         email = id_info.get("email")
@@ -171,39 +327,33 @@ def auth_google():
         picture = id_info.get("picture")
 
         if not email:
-            app.logger.error("Email not found in verified Google token.")
+            logger.error("Email not found in verified Google token.")
             return jsonify({"error": "Email not found in token"}), 400
 
-        app.logger.info(f"Attempting to add/update user: {email}")
-        user_db_id = db_utils.add_or_update_user(google_id, email, name, picture)
+        logger.debug("Attempting to add/update user: %s", email)
+        # The upsert returns the full row (including is_admin), so no second query
+        user_data = db_utils.add_or_update_user(google_id, email, name, picture)
 
-        if user_db_id is None:
-            app.logger.error("Database operation failed during add/update user.")
+        if user_data is None:
+            logger.error("Database operation failed during add/update user.")
             return jsonify({"error": "Database operation failed"}), 500
-
-        # Fetch the full user data (including is_admin) after add/update
-        user_data = db_utils.get_user_by_id(user_db_id)
-        if not user_data:
-            app.logger.error(
-                f"Failed to retrieve user data for ID {user_db_id} after add/update."
-            )
-            return jsonify({"error": "Could not retrieve user data after login"}), 500
+        user_db_id = user_data["id"]
 
         # --- Generate JWT ---
+        now = int(time.time())  # PyJWT takes epoch seconds as-is
         jwt_payload = {
             "user_id": user_db_id,
             "email": user_data["email"],  # Optional: include non-sensitive info
             "is_admin": user_data["is_admin"],  # Include admin status
-            "exp": datetime.now(timezone.utc)
-            + timedelta(hours=1),  # Token expires in 1 hour
-            "iat": datetime.now(timezone.utc),  # Issued at time
+            "exp": now + ACCESS_TOKEN_LIFETIME,  # Token expires in 1 hour
+            "iat": now,  # Issued at time
         }
-        access_token = jwt.encode(jwt_payload, JWT_SECRET_KEY, algorithm="HS256")
+        access_token = jwt_codec.encode(
+            jwt_payload, JWT_SECRET_KEY_BYTES, algorithm=JWT_ALGORITHMS[0]
+        )
         # --------------------
 
-        app.logger.info(
-            f"User processed successfully. DB ID: {user_db_id}. JWT issued."
-        )
+        logger.info("User processed successfully. DB ID: %s. JWT issued.", user_db_id)
         # Return user info AND the access token
         return jsonify(
             {
@@ -221,74 +371,145 @@ def auth_google():
         ), 200
 
     except ValueError as e:
-        # This catches id_token.verify_oauth2_token errors
-        app.logger.error(f"Google token verification failed: {e}")
+        # This catches verify_google_token errors
+        logger.error("Google token verification failed: %s", e)
         return jsonify({"error": "Invalid Google token", "details": str(e)}), 401
+    except db_utils.PoolTimeout:
+        raise  # Answered with 503 by handle_pool_timeout
     except Exception as e:
-        app.logger.error(
-            f"An unexpected error occurred during Google auth: {e}", exc_info=True
+        logger.error(
+            "An unexpected error occurred during Google auth: %s", e, exc_info=True
         )
         return jsonify({"error": "An internal server error occurred"}), 500
 
 
-@app.route("/api/users", methods=["GET", "OPTIONS"])
 @token_required  # Apply the JWT verification decorator
 def get_users():
     """
     API endpoint to retrieve a list of all users.
     Requires a valid JWT. Only allows access if the user is an admin.
     """
-    if request.method == "OPTIONS":
-        # OPTIONS requests are typically handled by CORS middleware or before decorators
-        # If token_required blocks OPTIONS, adjust CORS or the decorator
-        return app.make_default_options_response()
-
     # --- Authorization Check ---
     # The @token_required decorator already verified the token and put user data in g.current_user
     if not g.current_user or not g.current_user.get("is_admin"):
-        app.logger.warning(
-            f"Unauthorized attempt to access /api/users by user ID: {g.current_user.get('id') if g.current_user else 'Unknown'}"
+        logger.warning(
+            "Unauthorized attempt to access /api/users by user ID: %s",
+            g.current_user.get("id") if g.current_user else "Unknown",
         )
         return jsonify({"message": "Admin privileges required"}), 403  # Forbidden
     # ---------------------------
 
-    app.logger.info(f"Admin user ID {g.current_user['id']} accessing /api/users")
+    logger.info("Admin user ID %s accessing /api/users", g.current_user["id"])
 
+    # Rows are streamed from a server-side cursor and serialized one at a time,
+    # so memory stays bounded by the cursor batch size, not the table size.
+    users = db_utils.iter_all_users()
     try:
-        # Consider pagination here for large user bases
-        users = db_utils.get_all_users()
-        if users is None:
-            # This indicates an error within db_utils.get_all_users
-            app.logger.error(
-                "Failed to retrieve users from database (db_utils returned None)."
-            )
-            # Don't expose internal details, keep error generic
-            return jsonify({"error": "Failed to retrieve users"}), 500
+        first_user = next(users, None)  # Runs the query before headers are sent
+    except db_utils.PoolTimeout:
+        raise  # Answered with 503 by handle_pool_timeout
+    except Exception:
+        logger.error("Failed to retrieve users from database.", exc_info=True)
+        # Don't expose internal details, keep error generic
+        return jsonify({"error": "Failed to retrieve users"}), 500
+
+    def generate():
+        if first_user is None:
+            yield "[]"
+            return
+        count = 1
+        yield "[" + current_app.json.dumps(first_user)
+        for user in users:
+            count += 1
+            yield "," + current_app.json.dumps(user)
+        yield "]\n"
+        logger.info("Successfully streamed %d users for admin.", count)
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def handle_pool_timeout(error):
+    """
+    Answers requests that found every DB connection busy with 503 and a
+    Retry-After hint, so clients back off instead of seeing a generic error.
+    """
+    logger.warning("Database busy, shedding request: %s", error)
+    response = jsonify({"error": "Service busy, please retry"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
 
-        app.logger.info(f"Successfully retrieved {len(users)} users for admin.")
-        # Convert Row objects to plain dicts if not already done by DictCursor
-        # users_list = [dict(user) for user in users] # Already handled by DictCursor
-        return jsonify(users), 200
-    except Exception as e:
-        app.logger.error(
-            f"An unexpected error occurred in /api/users endpoint: {e}", exc_info=True
-        )
-        return jsonify({"error": "An internal server error occurred"}), 500
+
+class HealthCheckMiddleware:
+    """
+    WSGI middleware answering GET/HEAD /health before Flask sees the request,
+    so frequent liveness probes skip request context setup and routing.
+    """
+
+    body = b'{"status":"ok"}\n'
+    # A tuple, copied into a new list per call: servers and outer middleware
+    # may append to the list they are given
+    headers = (
+        ("Content-Type", "application/json"),
+        ("Content-Length", str(len(body))),
+    )
+
+    def __init__(self, wsgi_app, path="/health"):
+        self.wsgi_app = wsgi_app
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        method = environ.get("REQUEST_METHOD")
+        if environ.get("PATH_INFO") == self.path and method in ("GET", "HEAD"):
+            # Could add a DB connection check here too
+            start_response("200 OK", list(self.headers))
+            return [self.body] if method == "GET" else []
+        return self.wsgi_app(environ, start_response)
+
+
+# ---------------------
+
+
+def create_app(config=None):
+    """
+    Builds the Flask application. All routes, CORS and middleware are set up
+    here so every entry point gets the same configuration.
+
+    Args:
+        config (dict): Optional overrides applied to app.config.
+
+    Returns:
+        Flask: The configured application.
+    """
+    app = Flask(__name__)
+    app.json = OrjsonProvider(app)
+    # Login payloads are a single ID token; reject anything larger before parsing
+    app.config["MAX_CONTENT_LENGTH"] = 4096
+    if config:
+        app.config.update(config)
+
+    CORS(app, **CORS_OPTIONS)
+    logger.info("CORS enabled for origins: %s", allowed_origins)
+    app.before_request(short_circuit_preflight)
+    app.register_error_handler(db_utils.PoolTimeout, handle_pool_timeout)
+
+    app.add_url_rule("/api/auth/google", view_func=auth_google, methods=["POST"])
+    app.add_url_rule("/api/users", view_func=get_users, methods=["GET"])
+
+    app.wsgi_app = HealthCheckMiddleware(app.wsgi_app)
+    return app
 
 
-@app.route("/health", methods=["GET"])
-def health_check():
-    # Could add a DB connection check here too
-    return jsonify({"status": "ok"}), 200
+app = create_app()
 
 
 if __name__ == "__main__":
     # Use waitress or gunicorn for production instead of app.run()
     port = int(os.environ.get("PORT", 5001))  # Changed default port slightly
     host = "0.0.0.0"
-    app.logger.info(f"Starting Flask DEVELOPMENT server on {host}:{port}...")
-    app.logger.warning("Do NOT use Flask's development server in production!")
-    # For production use: gunicorn --bind 0.0.0.0:5001 app:app
+    logger.info("Starting Flask DEVELOPMENT server on %s:%s...", host, port)
+    logger.warning("Do NOT use Flask's development server in production!")
+    # For production use (see Procfile):
+    # gunicorn --worker-class gthread --workers 4 --threads 8 --bind 0.0.0.0:5001 db.app:app
     app.run(
         debug=False, host=host, port=port
     )  # debug=False is important for production-like testing
@@ -1,6 +1,11 @@
+import csv
+import io
 import logging
 import os
-import urllib.parse as urlparse
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 
 import psycopg2
 from dotenv import load_dotenv
@@ -18,97 +23,487 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 # ---------------------
 
-
-DATABASE_URL = os.getenv("DATABASE_URL")
-DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD = None, None, None, None, None
+# --- Environment ---
+# Every setting is read from the environment once, here, at import time
+_ENV = os.environ
+DATABASE_URL = _ENV.get("DATABASE_URL")
+# Optional replica for reads; reads share the primary when unset
+DATABASE_URL_READONLY = _ENV.get("DATABASE_URL_READONLY")
+# Pool sizes per worker process. Writes and reads get separate pools so a
+# slow write cannot starve login lookups. Each max should be at least the
+# worker's thread count (gunicorn --threads, 8 in the Procfile), and
+# workers * (write max + read max) must stay under the server's
+# max_connections. Connections returned beyond min are closed, so a low
+# min means reconnecting (and re-preparing statements) under load.
+DB_WRITE_POOL_MIN = int(_ENV.get("DB_WRITE_POOL_MIN", "4"))
+DB_WRITE_POOL_MAX = int(_ENV.get("DB_WRITE_POOL_MAX", "8"))
+DB_READ_POOL_MIN = int(_ENV.get("DB_READ_POOL_MIN", "8"))
+DB_READ_POOL_MAX = int(_ENV.get("DB_READ_POOL_MAX", "8"))
+# Seconds a request waits for a free pooled connection before giving up
+DB_POOL_TIMEOUT = float(_ENV.get("DB_POOL_TIMEOUT", "2.0"))
+# ---------------------
 
 # --- Database Connection Setup (using logger instead of print) ---
+# libpq keyword arguments for connect(); extra URL query parameters such as
+# sslmode are kept and passed through
+DB_CONNECT_PARAMS = {}
 if DATABASE_URL:
     logger.info("Connecting using DATABASE_URL from environment.")
     try:
-        url = urlparse.urlparse(DATABASE_URL)
-        DB_NAME = url.path[1:]
-        DB_USER = url.username
-        DB_PASSWORD = url.password
-        DB_HOST = url.hostname
-        DB_PORT = url.port or 5432
-        logger.info(f"  Parsed DB_HOST: {DB_HOST}")
-        logger.info(f"  Parsed DB_PORT: {DB_PORT}")
-        logger.info(f"  Parsed DB_NAME: {DB_NAME}")
-        logger.info(f"  Parsed DB_USER: {DB_USER}")
-        logger.info(f"  Parsed DB_PASSWORD is set: {bool(DB_PASSWORD)}")
+        # libpq's own parser: handles URIs and key=value DSNs, and percent-escapes
+        DB_CONNECT_PARAMS = psycopg2.extensions.parse_dsn(DATABASE_URL)
+        DB_CONNECT_PARAMS.setdefault("port", "5432")
     except Exception as parse_err:
-        logger.error(f"!!! ERROR parsing DATABASE_URL: {parse_err} !!!")
-        # Reset all on parse error
-        DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD = None, None, None, None, None
+        logger.error("!!! ERROR parsing DATABASE_URL: %s !!!", parse_err)
+        DB_CONNECT_PARAMS = {}  # Reset all on parse error
 else:
     logger.info("DATABASE_URL not found, falling back to individual DB_* variables.")
-    DB_HOST = os.getenv("DB_HOST")
-    DB_NAME = os.getenv("DB_NAME")
-    DB_USER = os.getenv("DB_USER")
-    DB_PORT = os.getenv("DB_PORT")
-    DB_PASSWORD = os.getenv("DB_PASSWORD")
-
-connection_pool = None
-try:
-    # Check if all necessary parameters were successfully determined
-    if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
-        logger.error(
-            "Error: Missing one or more required DB connection parameters. Cannot create pool."
-        )
-    else:
+    DB_CONNECT_PARAMS = {
+        "host": _ENV.get("DB_HOST"),
+        "port": _ENV.get("DB_PORT"),
+        "dbname": _ENV.get("DB_NAME"),
+        "user": _ENV.get("DB_USER"),
+        "password": _ENV.get("DB_PASSWORD"),
+    }
+
+DB_HOST = DB_CONNECT_PARAMS.get("host")
+DB_PORT = DB_CONNECT_PARAMS.get("port")
+DB_NAME = DB_CONNECT_PARAMS.get("dbname")
+DB_USER = DB_CONNECT_PARAMS.get("user")
+DB_PASSWORD = DB_CONNECT_PARAMS.get("password")
+if DATABASE_URL:
+    logger.info("  Parsed DB_HOST: %s", DB_HOST)
+    logger.info("  Parsed DB_PORT: %s", DB_PORT)
+    logger.info("  Parsed DB_NAME: %s", DB_NAME)
+    logger.info("  Parsed DB_USER: %s", DB_USER)
+    logger.info("  Parsed DB_PASSWORD is set: %s", bool(DB_PASSWORD))
+
+DB_READ_CONNECT_PARAMS = DB_CONNECT_PARAMS
+if DATABASE_URL_READONLY:
+    logger.info("Routing reads through DATABASE_URL_READONLY.")
+    try:
+        DB_READ_CONNECT_PARAMS = psycopg2.extensions.parse_dsn(DATABASE_URL_READONLY)
+        DB_READ_CONNECT_PARAMS.setdefault("port", "5432")
+    except Exception as parse_err:
+        logger.error("!!! ERROR parsing DATABASE_URL_READONLY: %s !!!", parse_err)
+
+# --- Connection Pool ---
+# Server-side cap on any single statement, so a stuck query cannot hold a
+# pooled connection (and the request thread waiting on it) indefinitely
+DB_STATEMENT_TIMEOUT_MS = 60000
+# Seconds libpq waits for the server when opening a connection, so an
+# unreachable database fails a request quickly instead of hanging it
+DB_CONNECT_TIMEOUT = 5
+# While the database is unreachable, rebuild the pool at most this often
+DB_POOL_RETRY_INTERVAL = 10
+
+
+class PoolTimeout(pool.PoolError):
+    """
+    No pooled connection became free within DB_POOL_TIMEOUT. Helpers let
+    this propagate instead of returning None, so callers can back off
+    (the API answers 503) rather than treat it as a missing row.
+    """
+
+
+class BlockingConnectionPool(pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that waits up to wait_timeout seconds for a
+    connection when all maxconn are checked out, instead of raising
+    "connection pool exhausted" immediately.
+    """
+
+    def __init__(self, minconn, maxconn, *args, wait_timeout=None, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._wait_timeout = wait_timeout
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self._wait_timeout):
+            raise PoolTimeout(f"No connection available within {self._wait_timeout}s.")
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        except Exception:
+            # The rollback of a dirty connection failed before the base pool
+            # forgot it; drop it here or it stays counted against maxconn
+            with self._lock:
+                key = self._rused.pop(id(conn), None)
+                if key is not None:
+                    self._used.pop(key, None)
+            if conn is not None and not conn.closed:
+                conn.close()
+            raise
+        finally:
+            self._slots.release()
+
+
+connection_pool = None  # Writes, and reads when no read pool is available
+read_connection_pool = None
+_connection_pool_lock = threading.Lock()
+_next_pool_attempt = 0.0  # time.monotonic() before which no rebuild is tried
+# Pool each checked-out connection came from, so it is returned to the same one
+_pool_of = weakref.WeakKeyDictionary()
+
+
+def _verify_schema(conn):
+    """
+    Logs which database, schema and user the pool connects as, and flags a
+    wrong database. The search_path and public.users existence probes only
+    run when DEBUG logging is enabled. Runs once per process at pool creation
+    instead of on every query.
+    """
+    try:
+        with conn.cursor() as diag_cur:  # Uses RealDictCursor from pool
+            diag_cur.execute(
+                "SELECT current_database() AS db_name, current_schema() AS schema_name, current_user AS user_name;"
+            )
+            identity = diag_cur.fetchone()
+            db_name = identity["db_name"]
+            logger.info(
+                "DIAGNOSTIC: Connected to DB='%s', Schema='%s', User='%s'",
+                db_name,
+                identity["schema_name"],
+                identity["user_name"],
+            )
+            if db_name != DB_NAME:
+                logger.error(
+                    "DIAGNOSTIC: Connected to WRONG database '%s'! Expected '%s'.",
+                    db_name,
+                    DB_NAME,
+                )
+
+            if not logger.isEnabledFor(logging.DEBUG):
+                return
+            diag_cur.execute("SHOW search_path;")  # Check active search path
+            search_path = diag_cur.fetchone()["search_path"]
+
+            # Check using information_schema
+            diag_cur.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM information_schema.tables
+                    WHERE table_schema = 'public' AND table_name = 'users'
+                );
+            """)
+            info_schema_exists = diag_cur.fetchone()["exists"]
+
+            # Check using pg_class system catalog
+            diag_cur.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_catalog.pg_class c
+                    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                    WHERE n.nspname = 'public' AND c.relname = 'users' AND c.relkind = 'r'
+                );
+            """)
+            pg_class_exists = diag_cur.fetchone()["exists"]
+
+            logger.debug("DIAGNOSTIC: Connection search_path: '%s'", search_path)
+            logger.debug(
+                "DIAGNOSTIC: Table 'public.users' exists check (information_schema): %s",
+                info_schema_exists,
+            )
+            logger.debug(
+                "DIAGNOSTIC: Table 'public.users' exists check (pg_class): %s",
+                pg_class_exists,
+            )
+
+            if not info_schema_exists or not pg_class_exists:
+                logger.error(
+                    "DIAGNOSTIC: 'public.users' table NOT FOUND by this connection via catalog/schema query!"
+                )
+
+    except Exception as diag_err:
+        logger.error("DIAGNOSTIC: Error during diagnostic queries: %s", diag_err)
+
+
+def _create_pool(label, minconn, maxconn, params, options="", verify=False):
+    """
+    Creates and tests one ThreadedConnectionPool. Returns it, or None if
+    creation failed. options are appended to any given in params; verify
+    runs _verify_schema on the test connection.
+    """
+    try:
         logger.info(
-            f"Attempting to create connection pool for {DB_USER}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+            "Attempting to create %s connection pool for %s@%s:%s/%s",
+            label,
+            params.get("user"),
+            params.get("host"),
+            params.get("port"),
+            params.get("dbname"),
         )
-        connection_pool = pool.SimpleConnectionPool(
-            1,  # minconn
-            10,  # maxconn - Consider making min/max pool size configurable
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT,
-            cursor_factory=extras.DictCursor,  # Use DictCursor globally for connections from this pool
+        # Thread-safe pool: gunicorn gthread workers share it across threads
+        connect_params = {
+            "application_name": "geography-game",
+            "connect_timeout": DB_CONNECT_TIMEOUT,
+            # TCP keepalives detect connections silently dropped by NAT
+            # or proxies before a request tries to use them
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 5,
+            **params,  # Settings given in the database URL win
+        }
+        # Keep any options from the database URL alongside ours
+        connect_params["options"] = " ".join(
+            filter(
+                None,
+                [
+                    params.get("options"),
+                    f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+                    options,
+                ],
+            )
+        )
+        new_pool = BlockingConnectionPool(
+            minconn,
+            maxconn,
+            wait_timeout=DB_POOL_TIMEOUT,
+            cursor_factory=extras.RealDictCursor,  # Rows are plain dicts built in C
+            **connect_params,
         )
         # Test connection immediately after pool creation
-        conn = connection_pool.getconn()
+        conn = new_pool.getconn()
         logger.info(
-            f"Successfully connected to database '{conn.info.dbname}' as user '{conn.info.user}'."
+            "Successfully connected to database '%s' as user '%s'.",
+            conn.info.dbname,
+            conn.info.user,
+        )
+        if verify:
+            _verify_schema(conn)
+        new_pool.putconn(conn)
+        logger.info("Database %s pool created and tested successfully.", label)
+        return new_pool
+
+    except (Exception, psycopg2.OperationalError) as e:
+        logger.error("Error creating %s connection pool: %s", label, e)
+        return None
+
+
+def init_connection_pool():
+    """
+    Creates the connection pools for this process if they do not exist yet.
+    Safe to call repeatedly; returns the write pool, or None if creation failed.
+    The read pool is best-effort: reads fall back to the write pool without it.
+
+    After a failed attempt, further calls return None without connecting
+    until DB_POOL_RETRY_INTERVAL has passed. While one thread is attempting,
+    others return None at once instead of queueing behind its connect.
+    """
+    global connection_pool, read_connection_pool, _next_pool_attempt
+    if connection_pool is not None:
+        return connection_pool
+    if time.monotonic() < _next_pool_attempt:
+        return None
+    if not _connection_pool_lock.acquire(blocking=False):
+        return None
+    try:
+        if connection_pool is not None:
+            return connection_pool
+        # Check if all necessary parameters were successfully determined
+        if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
+            logger.error(
+                "Error: Missing one or more required DB connection parameters. Cannot create pool."
+            )
+            _next_pool_attempt = time.monotonic() + DB_POOL_RETRY_INTERVAL
+            return None
+        connection_pool = _create_pool(
+            "write",
+            DB_WRITE_POOL_MIN,
+            DB_WRITE_POOL_MAX,
+            DB_CONNECT_PARAMS,
+            verify=True,
         )
-        connection_pool.putconn(conn)
-        logger.info("Database connection pool created and tested successfully.")
+        if connection_pool is not None and read_connection_pool is None:
+            # Reject writes outright, even when reads target the primary
+            read_connection_pool = _create_pool(
+                "read",
+                DB_READ_POOL_MIN,
+                DB_READ_POOL_MAX,
+                DB_READ_CONNECT_PARAMS,
+                options="-c default_transaction_read_only=on",
+            )
+        if connection_pool is None:
+            _next_pool_attempt = time.monotonic() + DB_POOL_RETRY_INTERVAL
+    finally:
+        _connection_pool_lock.release()
+    return connection_pool
+
+
+def _forget_inherited_pool():
+    # A forked child (e.g. gunicorn --preload) must not share the parent's
+    # sockets; it builds its own pools on first use instead.
+    global connection_pool, read_connection_pool, _connection_pool_lock
+    global _next_pool_attempt
+    connection_pool = None
+    read_connection_pool = None
+    _connection_pool_lock = threading.Lock()
+    _next_pool_attempt = 0.0
 
-except (Exception, psycopg2.OperationalError) as e:
-    logger.error(f"Error creating connection pool: {e}")
-    connection_pool = None  # Ensure pool is None if creation fails
+
+os.register_at_fork(after_in_child=_forget_inherited_pool)
+init_connection_pool()
+# ---------------------
 
 
-def get_db_connection():
-    """Gets a connection from the connection pool."""
-    if connection_pool:
+# --- Prepared Statements ---
+# Hot queries are PREPAREd once per connection so PostgreSQL can reuse the
+# parsed and planned statement; callers invoke them with EXECUTE.
+PREPARED_STATEMENTS = {
+    "upsert_user": """
+        INSERT INTO public.users (google_id, email, name, profile_picture_url, last_login, is_admin)
+        VALUES ($1, $2, $3, $4, NOW(), FALSE)
+        ON CONFLICT (google_id) DO UPDATE
+        SET email = EXCLUDED.email,
+            name = EXCLUDED.name,
+            profile_picture_url = EXCLUDED.profile_picture_url,
+            last_login = NOW()
+            -- is_admin = users.is_admin -- Retain existing value
+        RETURNING id, google_id, email, name, profile_picture_url, created_at, last_login, is_admin
+        """,
+    # Repeat logins with an unchanged profile only need last_login bumped
+    "touch_last_login": """
+        UPDATE public.users SET last_login = NOW()
+        WHERE google_id = $1
+          AND email IS NOT DISTINCT FROM $2
+          AND name IS NOT DISTINCT FROM $3
+          AND profile_picture_url IS NOT DISTINCT FROM $4
+        RETURNING id, google_id, email, name, profile_picture_url, created_at, last_login, is_admin
+        """,
+    "get_user_by_google_id": """
+        SELECT id, google_id, email, name, profile_picture_url, created_at, last_login, is_admin
+        FROM public.users WHERE google_id = $1
+        """,
+    "get_user_by_id": """
+        SELECT id, google_id, email, name, profile_picture_url, created_at, last_login, is_admin
+        FROM public.users WHERE id = $1
+        """,
+    "get_user_auth_fields": """
+        SELECT id, is_admin FROM public.users WHERE id = $1
+        """,
+    "add_game_score": """
+        INSERT INTO public.game_scores (user_id, game_mode, score)
+        VALUES ($1, $2, $3)
+        RETURNING id
+        """,
+}
+
+# Names already prepared on each live connection; entries vanish with the
+# connection object, so a replaced connection is prepared afresh.
+_prepared_on = weakref.WeakKeyDictionary()
+
+
+def _execute_prepared(cur, name, params):
+    """
+    Runs a PREPARED_STATEMENTS entry on cur, preparing it on first use.
+    If the server no longer knows the statement (e.g. after DEALLOCATE), it
+    is prepared again; if the server already has it while we had lost
+    track, it is used as is. Must not follow any write in its transaction
+    that should be kept, since recovery rolls the aborted transaction back.
+    """
+    conn = cur.connection
+    prepared = _prepared_on.setdefault(conn, set())
+    placeholders = ", ".join(["%s"] * len(params))
+    if name in prepared:
+        try:
+            cur.execute(f"EXECUTE {name} ({placeholders})", params)
+            return
+        except psycopg2.errors.InvalidSqlStatementName:
+            logger.warning("Prepared statement %s missing; preparing again.", name)
+            conn.rollback()
+            prepared.discard(name)
+    try:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+    except psycopg2.errors.DuplicatePreparedStatement:
+        conn.rollback()  # Already prepared on this session; just use it
+    prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+def get_db_connection(readonly=False):
+    """
+    Gets a connection from the connection pool.
+    readonly=True takes it from the read pool when one is available.
+    Returns None if no pool is available; raises PoolTimeout if the pool
+    stays exhausted for DB_POOL_TIMEOUT seconds.
+    """
+    write_pool = connection_pool or init_connection_pool()
+    db_pool = (readonly and read_connection_pool) or write_pool
+    if db_pool:
         try:
-            return connection_pool.getconn()
+            conn = db_pool.getconn()
+        except PoolTimeout as e:
+            logger.warning("Connection pool busy: %s", e)
+            raise
         except Exception as e:
-            logger.error(f"Error getting connection from pool: {e}")
+            logger.error("Error getting connection from pool: %s", e)
             return None
+        _pool_of[conn] = db_pool
+        return conn
     else:
         logger.warning("Connection pool is not available.")
         return None
 
 
 def release_db_connection(conn):
-    """Releases a connection back to the connection pool."""
-    if connection_pool and conn:
+    """Releases a connection back to the pool it was taken from."""
+    db_pool = _pool_of.pop(conn, None) if conn else None
+    if db_pool:
         try:
-            connection_pool.putconn(conn)
+            db_pool.putconn(conn)
         except Exception as e:
-            logger.error(f"Error releasing connection back to pool: {e}")
+            logger.error("Error releasing connection back to pool: %s", e)
+
+
+@contextmanager
+def db_conn(readonly=False, autocommit=None):
+    """
+    Checks a connection out of the pool for the duration of a with-block.
+    Commits if the block succeeds, rolls back if it raises, and always
+    returns the connection to the pool.
+
+    Args:
+        readonly (bool): Take the connection from the read pool.
+        autocommit (bool | None): Run in autocommit mode, so single-statement
+            reads skip the implicit BEGIN and the COMMIT/ROLLBACK round-trips.
+            Defaults to readonly. Not usable with named (server-side) cursors.
+
+    Raises:
+        pool.PoolError: If no connection is available.
+    """
+    if autocommit is None:
+        autocommit = readonly
+    conn = get_db_connection(readonly=readonly)
+    if not conn:
+        raise pool.PoolError("Failed to get DB connection.")
+    try:
+        if autocommit:
+            conn.autocommit = True
+        yield conn
+        conn.commit()  # No-op in autocommit mode
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception as rb_err:
+            logger.error("Error during rollback: %s", rb_err)
+        raise
+    finally:
+        if autocommit and not conn.closed:
+            conn.autocommit = False  # Back to the pool's default
+        release_db_connection(conn)
 
 
 def add_or_update_user(google_id, email, name, profile_picture_url):
     """
     Adds a new user or updates an existing user based on google_id.
     Updates the last_login timestamp. Does NOT update is_admin on conflict.
+    A returning user whose profile is unchanged only gets a plain UPDATE of
+    last_login; the upsert runs for new users and profile changes.
 
     Args:
         google_id (str): The unique Google ID of the user.
@@ -117,106 +512,33 @@ def add_or_update_user(google_id, email, name, profile_picture_url):
         profile_picture_url (str): URL to the user's profile picture.
 
     Returns:
-        int: The internal database ID of the user, or None if an error occurred.
+        dict: The user's full row (same columns as get_user_by_id), or None if
+        an error occurred. Returning the row saves a follow-up SELECT.
     """
-    # Qualify table name with 'public.' schema
-    sql = """
-    INSERT INTO public.users (google_id, email, name, profile_picture_url, last_login, is_admin)
-    VALUES (%s, %s, %s, %s, NOW(), FALSE)
-    ON CONFLICT (google_id) DO UPDATE
-    SET email = EXCLUDED.email,
-        name = EXCLUDED.name,
-        profile_picture_url = EXCLUDED.profile_picture_url,
-        last_login = NOW()
-        -- is_admin = users.is_admin -- Retain existing value (comment remains correct)
-    RETURNING id;
-    """
-    conn = None
-    user_id = None
     try:
-        conn = get_db_connection()
-        if conn:
-            # --- START DIAGNOSTIC BLOCK ---
-            try:
-                with conn.cursor() as diag_cur:  # Uses DictCursor from pool
-                    diag_cur.execute("SELECT current_database();")
-                    db_name = diag_cur.fetchone()["current_database"]
-                    diag_cur.execute("SELECT current_schema();")
-                    schema_name = diag_cur.fetchone()["current_schema"]
-                    diag_cur.execute("SELECT current_user;")
-                    user_name = diag_cur.fetchone()["current_user"]
-                    diag_cur.execute("SHOW search_path;")  # Check active search path
-                    search_path = diag_cur.fetchone()["search_path"]
-
-                    # Check using information_schema
-                    diag_cur.execute("""
-                        SELECT EXISTS (
-                            SELECT 1 FROM information_schema.tables
-                            WHERE table_schema = 'public' AND table_name = 'users'
-                        );
-                    """)
-                    info_schema_exists = diag_cur.fetchone()["exists"]
-
-                    # Check using pg_class system catalog
-                    diag_cur.execute("""
-                        SELECT EXISTS (
-                            SELECT 1 FROM pg_catalog.pg_class c
-                            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
-                            WHERE n.nspname = 'public' AND c.relname = 'users' AND c.relkind = 'r'
-                        );
-                    """)
-                    pg_class_exists = diag_cur.fetchone()["exists"]
-
-                    logger.info(
-                        f"DIAGNOSTIC: Connected to DB='{db_name}', Schema='{schema_name}', User='{user_name}'"
-                    )
-                    logger.info(f"DIAGNOSTIC: Connection search_path: '{search_path}'")
-                    logger.info(
-                        f"DIAGNOSTIC: Table 'public.users' exists check (information_schema): {info_schema_exists}"
-                    )
-                    logger.info(
-                        f"DIAGNOSTIC: Table 'public.users' exists check (pg_class): {pg_class_exists}"
-                    )
-
-                    if not info_schema_exists or not pg_class_exists:
-                        logger.error(
-                            "DIAGNOSTIC: 'public.users' table NOT FOUND by this connection via catalog/schema query!"
-                        )
-                    if db_name != DB_NAME:
-                        logger.error(
-                            f"DIAGNOSTIC: Connected to WRONG database '{db_name}'! Expected '{DB_NAME}'."
-                        )
-
-            except Exception as diag_err:
-                logger.error(f"DIAGNOSTIC: Error during diagnostic queries: {diag_err}")
-            # --- END DIAGNOSTIC BLOCK ---
-
-            # Proceed with original operation
-            with conn.cursor() as cur:  # Uses DictCursor from pool
-                cur.execute(sql, (google_id, email, name, profile_picture_url))
-                result = cur.fetchone()
-                if result:
-                    user_id = result["id"]  # Access by key with DictCursor
-                conn.commit()
-                logger.info(
-                    f"User {email} (Google ID: {google_id}) added or updated using public.users. DB ID: {user_id}"
-                )
-        else:
-            logger.error("Failed to get DB connection for add_or_update_user.")
-
+        with db_conn() as conn, conn.cursor() as cur:  # RealDictCursor from pool
+            params = (google_id, email, name, profile_picture_url)
+            _execute_prepared(cur, "touch_last_login", params)
+            user_data = cur.fetchone()
+            if user_data is None:  # New user, or name/email/picture changed
+                _execute_prepared(cur, "upsert_user", params)
+                user_data = cur.fetchone()
+    except PoolTimeout:
+        raise
     except (Exception, psycopg2.Error) as error:
         logger.error(
-            f"Error interacting with database in add_or_update_user (using public.users): {error}"
+            "Error interacting with database in add_or_update_user (using public.users): %s",
+            error,
         )
-        if conn:
-            try:
-                conn.rollback()
-            except Exception as rb_err:
-                logger.error(f"Error during rollback: {rb_err}")
-    finally:
-        if conn:
-            release_db_connection(conn)
-    return user_id
+        return None
+    # Per-login detail; debug level (and lazy args) keeps it off the hot path
+    logger.debug(
+        "User %s (Google ID: %s) added or updated. DB ID: %s",
+        email,
+        google_id,
+        user_data["id"],
+    )
+    return user_data
 
 
 def get_user_by_google_id(google_id):
@@ -229,24 +551,18 @@ def get_user_by_google_id(google_id):
     Returns:
         dict: A dictionary containing user data or None if not found/error.
     """
-    # Qualify table name for consistency during debugging
-    sql = "SELECT id, google_id, email, name, profile_picture_url, created_at, last_login, is_admin FROM public.users WHERE google_id = %s;"
-    conn = None
-    user_data = None
     try:
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur:  # Assumes DictCursor from pool
-                cur.execute(sql, (google_id,))
-                user_data = cur.fetchone()
-        else:
-            logger.error("Failed to get DB connection for get_user_by_google_id.")
+        with (
+            db_conn(readonly=True) as conn,
+            conn.cursor() as cur,  # RealDictCursor from pool
+        ):
+            _execute_prepared(cur, "get_user_by_google_id", (google_id,))
+            return cur.fetchone()
+    except PoolTimeout:
+        raise
     except (Exception, psycopg2.Error) as error:
-        logger.error(f"Error retrieving user by google_id: {error}")
-    finally:
-        if conn:
-            release_db_connection(conn)
-    return user_data
+        logger.error("Error retrieving user by google_id: %s", error)
+        return None
 
 
 def get_user_by_id(user_id):
@@ -259,65 +575,147 @@ def get_user_by_id(user_id):
     Returns:
         dict: A dictionary containing user data or None if not found/error.
     """
-    # Qualify table name for consistency during debugging
-    sql = "SELECT id, google_id, email, name, profile_picture_url, created_at, last_login, is_admin FROM public.users WHERE id = %s;"
-    conn = None
-    user_data = None
     try:
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur:  # Assumes DictCursor from pool
-                cur.execute(sql, (user_id,))
-                user_data = cur.fetchone()
-        else:
-            logger.error("Failed to get DB connection for get_user_by_id.")
+        with (
+            db_conn(readonly=True) as conn,
+            conn.cursor() as cur,  # RealDictCursor from pool
+        ):
+            _execute_prepared(cur, "get_user_by_id", (user_id,))
+            return cur.fetchone()
+    except PoolTimeout:
+        raise
     except (Exception, psycopg2.Error) as error:
-        logger.error(f"Error retrieving user by id: {error}")
-    finally:
-        if conn:
-            release_db_connection(conn)
-    return user_data
+        logger.error("Error retrieving user by id: %s", error)
+        return None
+
+
+def get_user_auth_fields(user_id):
+    """
+    Retrieves only the columns needed to authorize a request (id, is_admin).
+    Use this on per-request auth paths; get_user_by_id is for profile data.
+
+    Args:
+        user_id (int): The internal database ID of the user.
+
+    Returns:
+        dict: A dictionary with id and is_admin, or None if not found/error.
+    """
+    try:
+        with (
+            db_conn(readonly=True) as conn,
+            conn.cursor() as cur,  # RealDictCursor from pool
+        ):
+            _execute_prepared(cur, "get_user_auth_fields", (user_id,))
+            return cur.fetchone()
+    except PoolTimeout:
+        raise
+    except (Exception, psycopg2.Error) as error:
+        logger.error("Error retrieving auth fields for user id: %s", error)
+        return None
 
 
-def get_all_users():
+def get_all_users(limit=50, after=None):
     """
-    Retrieves all users from the database, ordered by last login time.
-    **Consider pagination for production.**
+    Retrieves one page of users, ordered by last login time (newest first).
+    Uses keyset pagination on (last_login, id): each page continues after
+    the previous page's last row instead of skipping OFFSET rows. Pages only
+    avoid sorting the table if public.users has an index on
+    (last_login DESC NULLS LAST, id DESC), which this repo does not create.
+
+    Args:
+        limit (int): Maximum number of users to return.
+        after (tuple | None): The next_cursor from the previous page, or
+            None for the first page.
 
     Returns:
-        list[dict]: A list of user dictionaries, or None if an error occurred.
+        tuple: (rows, next_cursor). rows is a list of user tuples (see
+        iter_all_users for column order); next_cursor is None on the last
+        page. Returns None if an error occurred.
+    """
+    columns = "id, email, name, profile_picture_url, created_at, last_login, is_admin"
+    # last_login is nullable: NULLs sort after every timestamp, so the
+    # cursor comparison has to be spelled out instead of a row comparison
+    if after is None:
+        where = ""
+        params = (limit,)
+    elif after[0] is None:
+        where = "WHERE last_login IS NULL AND id < %s"
+        params = (after[1], limit)
+    else:
+        where = """
+            WHERE last_login < %s
+               OR (last_login = %s AND id < %s)
+               OR last_login IS NULL
+            """
+        params = (after[0], after[0], after[1], limit)
+    sql = f"""
+        SELECT {columns} FROM public.users
+        {where}
+        ORDER BY last_login DESC NULLS LAST, id DESC
+        LIMIT %s;
+        """
+    try:
+        with (
+            db_conn(readonly=True) as conn,
+            conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur,
+        ):
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+    except PoolTimeout:
+        raise
+    except (Exception, psycopg2.Error) as error:
+        logger.error("Error retrieving all users: %s", error)
+        return None  # Return None on error
+    # A full page may have more behind it; (last_login, id) of its last row
+    next_cursor = (rows[-1][5], rows[-1][0]) if rows and len(rows) == limit else None
+    return rows, next_cursor
+
+
+def iter_all_users(batch_size=500):
+    """
+    Yields all users, ordered by last login time, streaming them from a
+    server-side cursor so the whole table is never held in memory.
+    The pooled connection is held until the generator is exhausted or closed.
+
+    Args:
+        batch_size (int): Number of rows fetched from the server per round-trip.
+
+    Yields:
+        tuple: One user row at a time, as (id, email, name,
+        profile_picture_url, created_at, last_login, is_admin). Plain tuples
+        are the cheapest row type and serialize straight to JSON arrays.
+
+    Raises:
+        psycopg2.Error: If no connection is available or the query fails.
     """
-    # Qualify table name for consistency during debugging
     sql = """
         SELECT id, email, name, profile_picture_url, created_at, last_login, is_admin
         FROM public.users
-        ORDER BY last_login DESC;
+        ORDER BY last_login DESC NULLS LAST, id DESC;
         """
-    conn = None
-    users_list = None  # Initialize as None to distinguish from empty list
     try:
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor(cursor_factory=extras.DictCursor) as cur:
-                cur.execute(sql)
-                users_list = cur.fetchall()  # Returns list of dicts or empty list
-        else:
-            logger.error("Failed to get DB connection for get_all_users.")
-
+        with (
+            # Named cursors need a transaction, so no autocommit here
+            db_conn(readonly=True, autocommit=False) as conn,
+            # Named => server-side
+            conn.cursor(
+                name="iter_all_users", cursor_factory=psycopg2.extensions.cursor
+            ) as cur,
+        ):
+            cur.itersize = batch_size
+            cur.execute(sql)
+            yield from cur
+    except PoolTimeout:
+        raise
     except (Exception, psycopg2.Error) as error:
-        logger.error(f"Error retrieving all users: {error}")
-        return None  # Return None on error
-    finally:
-        if conn:
-            release_db_connection(conn)
-    return (
-        users_list if users_list is not None else []
-    )  # Return empty list if query succeeded but no users
+        logger.error("Error streaming all users: %s", error)
+        raise
 
 
 def add_game_score(user_id, game_mode, score):
     """
     Adds a game score entry for a specific user.
+    Thin wrapper over add_game_scores_bulk with a single row.
 
     Args:
         user_id (int): The internal database ID of the user.
@@ -327,44 +725,93 @@ def add_game_score(user_id, game_mode, score):
     Returns:
         int: The ID of the newly inserted score record, or None if an error occurred.
     """
-    # Assuming game_scores is also in public schema, qualify if needed
-    sql = """
-    INSERT INTO public.game_scores (user_id, game_mode, score)
-    VALUES (%s, %s, %s)
-    RETURNING id;
+    score_ids = add_game_scores_bulk([(user_id, game_mode, score)])
+    return score_ids[0] if score_ids else None
+
+
+def bulk_copy_game_scores(rows):
+    """
+    Imports game scores for backfills and other large loads. Rows are COPYed
+    into a transaction-scoped staging table, then moved into
+    public.game_scores with one INSERT ... SELECT. The import is all or
+    nothing: any failing row (e.g. an unknown user_id) rolls back the batch.
+    Rows are not deduplicated, so re-running an import inserts them again.
+
+    Args:
+        rows (iterable[tuple[int, str, int]]): (user_id, game_mode, score) tuples.
+
+    Returns:
+        int: The number of rows inserted, or None if an error occurred.
     """
-    conn = None
-    score_id = None
     try:
-        conn = get_db_connection()
-        if conn:
-            with conn.cursor() as cur:  # Assumes DictCursor from pool
-                cur.execute(sql, (user_id, game_mode, score))
-                result = cur.fetchone()
-                if result:
-                    score_id = result["id"]
-                conn.commit()
-                logger.info(
-                    f"Score added for user ID {user_id} in mode '{game_mode}'. Score ID: {score_id}"
-                )
-        else:
-            logger.error("Failed to get DB connection for add_game_score.")
+        with db_conn() as conn, conn.cursor() as cur:
+            # Column types are copied from game_scores; constraints and defaults are not
+            cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS tmp_game_scores ON COMMIT DROP AS
+                SELECT user_id, game_mode, score FROM public.game_scores WITH NO DATA;
+                """)
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            cur.copy_expert(
+                "COPY tmp_game_scores (user_id, game_mode, score) FROM STDIN WITH (FORMAT CSV)",
+                buf,
+            )
+            cur.execute("""
+                INSERT INTO public.game_scores (user_id, game_mode, score)
+                SELECT user_id, game_mode, score FROM tmp_game_scores;
+                """)
+            inserted = cur.rowcount
+    except PoolTimeout:
+        raise
+    except (Exception, psycopg2.Error) as error:
+        logger.error("Error copying game scores: %s", error)
+        return None
+    logger.info("Copied %s game scores.", inserted)
+    return inserted
+
+
+def add_game_scores_bulk(rows, page_size=100):
+    """
+    Adds many game score entries in as few round-trips as possible, using
+    multi-row INSERTs of page_size rows each. For imports where the new IDs
+    are not needed, bulk_copy_game_scores is faster.
+
+    Args:
+        rows (list[tuple[int, str, int]]): (user_id, game_mode, score) tuples.
+        page_size (int): Rows per INSERT statement.
 
+    Returns:
+        list[int]: The new score IDs, or None if an error occurred.
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            if len(rows) == 1:
+                # A single row reuses the connection's prepared INSERT
+                _execute_prepared(cur, "add_game_score", rows[0])
+                result = [cur.fetchone()["id"]]
+            else:
+                inserted = extras.execute_values(
+                    cur,
+                    "INSERT INTO public.game_scores (user_id, game_mode, score) VALUES %s RETURNING id",
+                    rows,
+                    template="(%s, %s, %s)",
+                    page_size=page_size,
+                    fetch=True,
+                )
+                result = [row["id"] for row in inserted]
+    except PoolTimeout:
+        raise
     except (Exception, psycopg2.Error) as error:
-        logger.error(f"Error adding game score: {error}")
+        logger.error("Error adding game scores: %s", error)
         if isinstance(error, psycopg2.errors.ForeignKeyViolation):
-            logger.warning(
-                f"Attempted to add score for non-existent user ID {user_id}."
-            )
-        if conn:
-            try:
-                conn.rollback()
-            except Exception as rb_err:
-                logger.error(f"Error during rollback: {rb_err}")
-    finally:
-        if conn:
-            release_db_connection(conn)
-    return score_id
+            logger.warning("Attempted to add score for a non-existent user ID.")
+        return None
+    logger.debug("Added %d game scores.", len(rows))
+    return result
 
 
 # --- Main block (for testing) ---
@@ -381,18 +828,19 @@ if __name__ == "__main__":
         test_email = f"test.user.{os.urandom(4).hex()}@example.com"
         test_name = "Test User"
         test_pic = "https://example.com/profile.jpg"
-        user_db_id = add_or_update_user(test_google_id, test_email, test_name, test_pic)
+        user_row = add_or_update_user(test_google_id, test_email, test_name, test_pic)
+        user_db_id = user_row["id"] if user_row else None
 
         if user_db_id:
             logger.info(
-                f"User added/updated successfully. Internal DB ID: {user_db_id}"
+                "User added/updated successfully. Internal DB ID: %s", user_db_id
             )
 
             logger.info("\n--- Testing get_user_by_google_id ---")
             retrieved_user = get_user_by_google_id(test_google_id)
             if retrieved_user:
                 logger.info(
-                    f"Retrieved user data by Google ID: {dict(retrieved_user)}"
+                    "Retrieved user data by Google ID: %s", dict(retrieved_user)
                 )  # Log as dict
             else:
                 logger.error("Failed to retrieve user by Google ID.")
@@ -401,7 +849,7 @@ if __name__ == "__main__":
             retrieved_user_by_id = get_user_by_id(user_db_id)
             if retrieved_user_by_id:
                 logger.info(
-                    f"Retrieved user data by DB ID: {dict(retrieved_user_by_id)}"
+                    "Retrieved user data by DB ID: %s", dict(retrieved_user_by_id)
                 )
             else:
                 logger.error("Failed to retrieve user by DB ID.")
@@ -411,22 +859,32 @@ if __name__ == "__main__":
             score = 1500
             score_db_id = add_game_score(user_db_id, game_mode, score)
             if score_db_id:
-                logger.info(f"Game score added successfully. Score ID: {score_db_id}")
+                logger.info("Game score added successfully. Score ID: %s", score_db_id)
             else:
                 logger.error("Failed to add game score.")
 
             logger.info("\n--- Testing add_game_score for non-existent user ---")
             add_game_score(999999, "flag_match", 500)  # Use a clearly non-existent ID
 
+            logger.info("\n--- Testing add_game_scores_bulk ---")
+            score_ids = add_game_scores_bulk(
+                [(user_db_id, "capital_quiz", n * 100) for n in range(5)]
+            )
+            if score_ids is not None:
+                logger.info("Bulk scores added successfully. Score IDs: %s", score_ids)
+            else:
+                logger.error("Failed to add game scores in bulk.")
+
             logger.info("\n--- Testing get_all_users ---")
-            all_users = get_all_users()
-            if all_users is not None:  # Check if None wasn't returned due to error
-                logger.info(f"Retrieved {len(all_users)} users:")
-                # Log first few users as dicts for readability
-                for user in all_users[:3]:
-                    logger.info(dict(user))
-                if len(all_users) > 3:
-                    logger.info("...")
+            page = get_all_users(limit=3)
+            if page is not None:  # Check if None wasn't returned due to error
+                users_page, next_cursor = page
+                logger.info("Retrieved %s users:", len(users_page))
+                # Log first page of users for readability
+                for user in users_page:
+                    logger.info(user)
+                if next_cursor is not None:
+                    logger.info("... more after %s", next_cursor)
             else:
                 logger.error("Failed to retrieve all users (function returned None).")
 
@@ -434,6 +892,8 @@ if __name__ == "__main__":
             logger.error("Failed to add or update user during test.")
 
         # Close pool at the end of tests
+        if read_connection_pool:
+            read_connection_pool.closeall()
         if connection_pool:
             connection_pool.closeall()
             logger.info("\nConnection pool closed.")
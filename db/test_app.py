@@ -0,0 +1,118 @@
+import os
+import time
+
+import jwt
+import pytest
+
+os.environ.setdefault("GOOGLE_CLIENT_ID", "test-client-id")
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret-key-of-at-least-32-bytes")
+
+import app as app_module  # Reads the env above at import
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # A non-admin user: an accepted token gets 403 from /api/users, not 401
+    monkeypatch.setattr(
+        app_module.db_utils,
+        "get_user_auth_fields",
+        lambda user_id: {"id": user_id, "is_admin": False},
+    )
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def token():
+    now = int(time.time())
+    return jwt.encode(
+        {"user_id": 7, "iat": now, "exp": now + 60},
+        app_module.JWT_SECRET_KEY_BYTES,
+        algorithm="HS256",
+    )
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        "Bearer {}",
+        "bearer {}",
+        "Bearer\t{}",
+        "Bearer   {}",
+        " Bearer {} ",
+    ],
+)
+def test_authorization_header_accepted(client, token, header):
+    response = client.get("/api/users", headers={"Authorization": header.format(token)})
+
+    assert response.status_code == 403
+    assert response.get_json() == {"message": "Admin privileges required"}
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        "",
+        "Bearer",
+        "Bearer ",
+        "{}",
+        "Token {}",
+        "Basic {}",
+        "Bearer {} extra",  # Tokens never contain whitespace
+    ],
+)
+def test_authorization_header_malformed(client, token, header):
+    response = client.get("/api/users", headers={"Authorization": header.format(token)})
+
+    assert response.status_code == 401
+    assert response.get_json() == {"message": "Malformed token header"}
+
+
+def test_authorization_header_missing(client):
+    response = client.get("/api/users")
+
+    assert response.status_code == 401
+    assert response.get_json() == {"message": "Token is missing!"}
+
+
+def test_health_check_headers_are_not_shared_between_calls():
+    middleware = app_module.HealthCheckMiddleware(app_module.app.wsgi_app)
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/health"}
+    sent = []
+
+    def start_response(status, headers):
+        sent.append(list(headers))
+        headers.append(("X-Outer", "1"))  # As an outer middleware might
+
+    assert middleware(environ, start_response) == [b'{"status":"ok"}\n']
+    middleware(environ, start_response)
+
+    assert sent[0] == sent[1]
+    assert ("X-Outer", "1") not in sent[1]
+
+
+PREFLIGHT_HEADERS = {
+    "Origin": "https://kmarchais.github.io",
+    "Access-Control-Request-Method": "GET",
+}
+
+
+def test_preflight_is_answered_before_the_view(client):
+    response = client.options("/api/users", headers=PREFLIGHT_HEADERS)
+
+    assert response.status_code == 204
+    assert (
+        response.headers["Access-Control-Allow-Origin"] == PREFLIGHT_HEADERS["Origin"]
+    )
+
+
+def test_preflight_for_unknown_route_is_not_found(client):
+    response = client.options("/api/nope", headers=PREFLIGHT_HEADERS)
+
+    assert response.status_code == 404
+
+
+def test_plain_options_is_left_to_flask(client):
+    response = client.options("/api/users")
+
+    assert response.status_code == 200
+    assert "GET" in response.headers["Allow"]
@@ -0,0 +1,141 @@
+import threading
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import pytest
+from db_utils import BlockingConnectionPool, PoolTimeout, _execute_prepared
+
+
+class FakeInfo:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    """
+    Just enough of a connection for the pool's bookkeeping, plus a server
+    session that tracks PREPAREd statement names.
+    """
+
+    def __init__(self):
+        self.closed = 0
+        self.info = FakeInfo()
+        self.rollback_error = None
+        self.rollbacks = 0
+        self.server_prepared = set()
+        self.statements = []  # (verb, name) of every PREPARE/EXECUTE sent
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        if self.rollback_error is not None:
+            raise self.rollback_error
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, params=None):
+        verb, name = sql.split()[:2]
+        self.connection.statements.append((verb, name))
+        if verb == "PREPARE":
+            if name in self.connection.server_prepared:
+                raise psycopg2.errors.DuplicatePreparedStatement(name)
+            self.connection.server_prepared.add(name)
+        elif name not in self.connection.server_prepared:
+            raise psycopg2.errors.InvalidSqlStatementName(name)
+
+
+class FakePool(BlockingConnectionPool):
+    """BlockingConnectionPool that never touches a database."""
+
+    def _connect(self, key=None):
+        conn = FakeConnection()
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+
+def test_getconn_times_out_when_exhausted():
+    db_pool = FakePool(0, 1, wait_timeout=0.05)
+    db_pool.getconn()
+
+    with pytest.raises(PoolTimeout):
+        db_pool.getconn()
+
+
+def test_waiting_getconn_gets_connection_put_back():
+    db_pool = FakePool(1, 1, wait_timeout=2)
+    conn = db_pool.getconn()
+    threading.Timer(0.05, db_pool.putconn, args=(conn,)).start()
+
+    assert db_pool.getconn() is conn
+
+
+def test_putconn_releases_slot_when_rollback_fails():
+    db_pool = FakePool(1, 1, wait_timeout=0.05)
+    conn = db_pool.getconn()
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+    conn.rollback_error = psycopg2.OperationalError("server closed the connection")
+
+    with pytest.raises(psycopg2.OperationalError):
+        db_pool.putconn(conn)
+
+    assert db_pool.getconn() is not conn
+
+
+def test_prepared_statement_is_prepared_once():
+    conn = FakeConnection()
+
+    _execute_prepared(conn.cursor(), "get_user_by_id", (1,))
+    _execute_prepared(conn.cursor(), "get_user_by_id", (2,))
+
+    assert conn.statements == [
+        ("PREPARE", "get_user_by_id"),
+        ("EXECUTE", "get_user_by_id"),
+        ("EXECUTE", "get_user_by_id"),
+    ]
+
+
+def test_missing_prepared_statement_is_prepared_again():
+    conn = FakeConnection()
+    _execute_prepared(conn.cursor(), "get_user_by_id", (1,))
+    _execute_prepared(conn.cursor(), "get_user_auth_fields", (1,))
+    conn.server_prepared.discard("get_user_by_id")  # e.g. DEALLOCATE
+    conn.statements.clear()
+
+    _execute_prepared(conn.cursor(), "get_user_by_id", (1,))
+    _execute_prepared(conn.cursor(), "get_user_auth_fields", (1,))
+
+    assert conn.statements == [
+        ("EXECUTE", "get_user_by_id"),
+        ("PREPARE", "get_user_by_id"),
+        ("EXECUTE", "get_user_by_id"),
+        # Recovering one statement keeps track of the others
+        ("EXECUTE", "get_user_auth_fields"),
+    ]
+    assert conn.rollbacks == 1
+
+
+def test_duplicate_prepare_is_treated_as_prepared():
+    conn = FakeConnection()
+    conn.server_prepared.add("get_user_by_id")  # Prepared, but not tracked
+
+    _execute_prepared(conn.cursor(), "get_user_by_id", (1,))
+    _execute_prepared(conn.cursor(), "get_user_by_id", (2,))
+
+    assert conn.statements == [
+        ("PREPARE", "get_user_by_id"),
+        ("EXECUTE", "get_user_by_id"),
+        ("EXECUTE", "get_user_by_id"),
+    ]
+    assert conn.rollbacks == 1